@@ -1,97 +1,333 @@
 import os
+import re
+import asyncio
+import time
+import itertools
+import threading
 import json
-from datetime import datetime, timedelta
-import pytz
+import sqlite3
+from datetime import datetime, timedelta, time as dtime
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from functools import lru_cache
+from operator import itemgetter
 from typing import Optional
+from zoneinfo import ZoneInfo
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.error import BadRequest
 from telegram.ext import (
-    ApplicationBuilder, CommandHandler, CallbackQueryHandler,
-    ContextTypes, MessageHandler, filters
+    AIORateLimiter, ApplicationBuilder, BaseUpdateProcessor, CommandHandler,
+    CallbackQueryHandler, ContextTypes, MessageHandler, filters
 )
 
+try:
+    # faster event loop for the webhook server; must be set before the app builds its loop
+    import uvloop
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except ImportError:
+    pass
+
 TOKEN = os.environ.get("BOT_TOKEN")
 WEBHOOK_URL = os.environ.get("RENDER_EXTERNAL_URL")  # just host; webhook builder uses it below
 
-KYIV_TZ = pytz.timezone("Europe/Kyiv")
-DATA_FILE = "reminders.json"
+KYIV_TZ = ZoneInfo("Europe/Kyiv")
+# point this at a persistent disk mount so reminders survive redeploys
+DB_FILE = os.environ.get("REMINDERS_DB", "reminders.db")
+# older releases kept reminders in a JSON file; imported once into DB_FILE
+LEGACY_DATA_FILE = os.environ.get("REMINDERS_FILE", "reminders.json")
+
+# abandoned add-reminder flows are forgotten after this many seconds
+CONVERSATION_TTL = 600
+
+# the "use the menu" fallback reply goes out at most once per this many seconds per chat
+MENU_HINT_COOLDOWN = 30
 
-# in-memory: { chat_id: [ { "id": str, "task": str, "time": datetime(tz=KYIV_TZ), "repeat": str } , ... ] }
+# pending saves are coalesced for this many seconds before hitting the disk
+SAVE_DELAY = 0.5
+
+# in-memory: { chat_id: { job_id: { "id": str, "task": str, "time": datetime(tz=KYIV_TZ), "repeat": str }, ... } }
 reminders: dict = {}
 
+# changes not yet written: { "op": "add"|"update"|"del", "id": str, "row": (...) }
+_pending_ops: list = []
+_db: Optional[sqlite3.Connection] = None
+# serializes database writers; they run on worker threads via asyncio.to_thread
+_write_lock = threading.Lock()
+
+# background writer state (see request_save)
+_save_event: Optional[asyncio.Event] = None
+_save_task: Optional[asyncio.Task] = None
+_save_stopping = False
+
 # ---------------- persistence ----------------
+def reminder_row(chat_id: int, r: dict) -> tuple:
+    # column order of the reminders table
+    return (r["id"], chat_id, r["task"], r["time"].isoformat(), r["repeat"])
+
+def all_reminder_rows() -> list:
+    return [reminder_row(chat_id, r) for chat_id, lst in reminders.items() for r in lst.values()]
+
+def open_db() -> sqlite3.Connection:
+    global _db
+    if _db is None:
+        _db = sqlite3.connect(DB_FILE, check_same_thread=False)
+        # WAL: a change appends its pages instead of rewriting the file
+        _db.execute("PRAGMA journal_mode=WAL")
+        _db.execute("PRAGMA synchronous=NORMAL")
+        _db.execute(
+            "CREATE TABLE IF NOT EXISTS reminders ("
+            "job_id TEXT PRIMARY KEY, chat_id INTEGER NOT NULL, "
+            "task TEXT NOT NULL, time TEXT NOT NULL, repeat TEXT NOT NULL)"
+        )
+        _db.execute("CREATE INDEX IF NOT EXISTS reminders_chat_id ON reminders (chat_id)")
+    return _db
+
+def apply_ops(ops: list):
+    """Write queued changes in one transaction."""
+    with _write_lock, open_db() as db:
+        for op in ops:
+            if op["op"] == "del":
+                db.execute("DELETE FROM reminders WHERE job_id = ?", (op["id"],))
+            else:
+                db.execute("INSERT OR REPLACE INTO reminders VALUES (?, ?, ?, ?, ?)", op["row"])
+
+def store_all_reminders(rows: list):
+    """Replace every stored reminder with `rows`."""
+    with _write_lock, open_db() as db:
+        db.execute("DELETE FROM reminders")
+        db.executemany("INSERT INTO reminders VALUES (?, ?, ?, ?, ?)", rows)
+
+def close_db():
+    global _db
+    with _write_lock:
+        if _db is not None:
+            _db.close()
+            _db = None
+
+def log_op(op: str, chat_id: int, rem: dict):
+    """Record one change to a reminder ('add', 'update' or 'del') and schedule a save."""
+    record = {"op": op, "id": rem["id"]}
+    if op != "del":
+        record["row"] = reminder_row(chat_id, rem)
+    _pending_ops.append(record)
+    request_save()
+
 def save_reminders():
-    out = {}
-    for chat_id, lst in reminders.items():
-        out[str(chat_id)] = [
-            {"id": r.get("id"), "task": r["task"], "time": r["time"].astimezone(KYIV_TZ).isoformat(), "repeat": r["repeat"]}
-            for r in lst
-        ]
-    with open(DATA_FILE, "w", encoding="utf-8") as f:
-        json.dump(out, f, ensure_ascii=False, indent=2)
+    """Blocking save of pending changes; handlers should use request_save() instead."""
+    if _pending_ops:
+        ops = _pending_ops[:]
+        _pending_ops.clear()
+        apply_ops(ops)
+
+def request_save():
+    """Ask the background writer to persist pending changes; a burst of calls becomes one transaction."""
+    if _save_event is None:
+        # writer not running (startup) -> write right away
+        save_reminders()
+    else:
+        _save_event.set()
+
+async def _save_worker():
+    while True:
+        await _save_event.wait()
+        if not _save_stopping:
+            await asyncio.sleep(SAVE_DELAY)  # coalescing window
+        _save_event.clear()
+        ops = _pending_ops[:]
+        _pending_ops.clear()
+        try:
+            if ops:
+                await asyncio.to_thread(apply_ops, ops)
+        except sqlite3.Error:
+            # keep the writer alive; changes that didn't make it go out with the next save
+            _pending_ops[:0] = ops
+        if _save_stopping and not _save_event.is_set():
+            return
+
+async def start_save_worker(app):
+    global _save_event, _save_task
+    _save_event = asyncio.Event()
+    _save_task = asyncio.create_task(_save_worker())
+
+async def stop_save_worker(app):
+    """Flush pending changes and stop the writer."""
+    global _save_event, _save_stopping
+    if _save_task is not None:
+        _save_stopping = True
+        _save_event.set()
+        await _save_task
+        _save_event = None
+    close_db()
+
+def import_legacy_reminders() -> list:
+    """Move reminders from the old JSON file into the database; returns the rows."""
+    if not os.path.exists(LEGACY_DATA_FILE):
+        return []
+    with open(LEGACY_DATA_FILE, "rb") as f:
+        data = json.load(f)
+    stored = {}
+    for chat_id_str, lst in data.items():
+        chat_id = int(chat_id_str)
+        for item in lst:
+            job_id = item.get("id") or make_job_id(chat_id, datetime.fromisoformat(item["time"]))
+            stored[job_id] = (job_id, chat_id, item["task"], item["time"], item.get("repeat", "once"))
+    rows = list(stored.values())
+    store_all_reminders(rows)
+    # keep the old file around, but never import it twice
+    os.replace(LEGACY_DATA_FILE, LEGACY_DATA_FILE + ".migrated")
+    return rows
 
 def load_reminders():
     global reminders
     reminders = {}
-    if not os.path.exists(DATA_FILE):
-        return
-    with open(DATA_FILE, "r", encoding="utf-8") as f:
-        data = json.load(f)
+    rows = open_db().execute("SELECT job_id, chat_id, task, time, repeat FROM reminders").fetchall()
+    if not rows:
+        rows = import_legacy_reminders()
+
     now = datetime.now(KYIV_TZ)
-    for chat_id_str, lst in data.items():
-        parsed = []
-        for item in lst:
-            # parse ISO datetime safely
-            dt = datetime.fromisoformat(item["time"])
-            if dt.tzinfo is None:
-                dt = KYIV_TZ.localize(dt)
-            else:
-                dt = dt.astimezone(KYIV_TZ)
-            repeat = item.get("repeat", "once")
-            # if once and already passed -> skip
-            if repeat == "once" and dt <= now:
+    for job_id, chat_id, task, time_str, repeat in rows:
+        # parse ISO datetime safely
+        dt = datetime.fromisoformat(time_str)
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=KYIV_TZ)
+        else:
+            dt = dt.astimezone(KYIV_TZ)
+        # if once and already passed -> skip
+        if repeat == "once" and dt <= now:
+            continue
+        # if repeating and time already passed -> compute next occurrence
+        if repeat != "once" and dt <= now:
+            next_dt = find_next_time(now, dt.timetz(), repeat)
+            if next_dt is None:
                 continue
-            # if repeating and time already passed -> compute next occurrence
-            if repeat != "once" and dt <= now:
-                next_dt = find_next_time(now, dt.timetz(), repeat)
-                if next_dt is None:
-                    continue
-                dt = next_dt
-            parsed.append({"id": item.get("id"), "task": item["task"], "time": dt, "repeat": repeat})
-        if parsed:
-            reminders[int(chat_id_str)] = parsed
+            dt = next_dt
+        reminders.setdefault(chat_id, {})[job_id] = {"id": job_id, "task": task, "time": dt, "repeat": repeat}
+
+# ---------------- keyboards ----------------
+# static markups are built once and shared by every handler
+MAIN_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("➕ Додати нагадування", callback_data="set_reminder")],
+    [InlineKeyboardButton("📋 Список нагадувань", callback_data="list_reminders")]
+])
+
+BACK_BUTTON = InlineKeyboardButton("⬅ Назад", callback_data="main_menu")
+BACK_ROW = (BACK_BUTTON,)
+BACK_MARKUP = InlineKeyboardMarkup([BACK_ROW])
+
+REPEAT_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Один раз", callback_data="repeat_once")],
+    [InlineKeyboardButton("Будні", callback_data="repeat_weekdays")],
+    [InlineKeyboardButton("Вихідні", callback_data="repeat_weekends")],
+    [InlineKeyboardButton("Щодня", callback_data="repeat_daily")],
+    BACK_ROW
+])
+
+# (chat_id, message_id) -> (text, reply_markup) last shown by safe_edit_message_text, LRU-bounded
+LAST_EDITS_MAX = 1024
+_last_edits: OrderedDict = OrderedDict()
+
+# callback_data patterns, compiled once
+DELETE_RE = re.compile(r"^delete_([\w-]+)$")
+REPEAT_RE = re.compile(r"^repeat_(once|daily|weekdays|weekends)$")
 
 # ---------------- helpers ----------------
-def format_time_delta(td: timedelta) -> str:
-    if td.total_seconds() <= 0:
+def format_time_delta_seconds(seconds: float) -> str:
+    if seconds <= 0:
         return "0 хв"
-    days = td.days
-    hours, rem = divmod(td.seconds, 3600)
-    minutes = rem // 60
-    parts = []
-    if days:
-        parts.append(f"{days} дн")
+    return format_time_delta_minutes(int(seconds // 60))
+
+@lru_cache(maxsize=4096)
+def format_time_delta_minutes(total_minutes: int) -> str:
+    # most reminders are less than a day away: at most hours + minutes, no joining needed
+    if total_minutes < 60:
+        return f"{total_minutes} хв" if total_minutes else "менше 1 хв"
+    hours, minutes = divmod(total_minutes, 60)
+    if hours < 24:
+        return f"{hours} год {minutes} хв" if minutes else f"{hours} год"
+    days, hours = divmod(hours, 24)
+    text = f"{days} дн"
     if hours:
-        parts.append(f"{hours} год")
+        text += f" {hours} год"
     if minutes:
-        parts.append(f"{minutes} хв")
-    return " ".join(parts) if parts else "менше 1 хв"
-
-def main_menu() -> InlineKeyboardMarkup:
-    keyboard = [
-        [InlineKeyboardButton("➕ Додати нагадування", callback_data="set_reminder")],
-        [InlineKeyboardButton("📋 Список нагадувань", callback_data="list_reminders")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+        text += f" {minutes} хв"
+    return text
 
 async def safe_edit_message_text(query, text, **kwargs):
+    message = query.message
+    key = (message.chat.id, message.message_id)
+    state = (text, kwargs.get("reply_markup"))
+    if _last_edits.get(key) == state:
+        # this exact content was already put on this message; skip the round-trip
+        _last_edits.move_to_end(key)
+        return
+    # forget the old state first: if the edit fails or times out after Telegram applied it,
+    # the cache must not claim the message still shows the previous screen
+    _last_edits.pop(key, None)
     try:
-        cur = query.message.text or ""
-        if cur != text or ("reply_markup" in kwargs and query.message.reply_markup != kwargs.get("reply_markup")):
+        cur = message.text or ""
+        if cur != text or ("reply_markup" in kwargs and message.reply_markup != kwargs.get("reply_markup")):
             await query.edit_message_text(text, **kwargs)
     except BadRequest as e:
         if "Message is not modified" not in str(e):
             raise
+    _last_edits[key] = state
+    if len(_last_edits) > LAST_EDITS_MAX:
+        _last_edits.popitem(last=False)
+
+@dataclass(slots=True)
+class UserState:
+    """A user's add-reminder flow in progress."""
+    step: Optional[str] = None
+    step_ts: float = 0.0
+    task: Optional[str] = None
+    remind_dt: Optional[datetime] = None
+
+# user_id -> UserState; kept here rather than in context.user_data because without
+# persistence PTB remembers every dropped user id, so prune_state could never free it
+_user_states: dict = {}
+# chat_id -> monotonic time of the last "use the menu" reply (see MENU_HINT_COOLDOWN)
+_menu_hints: dict = {}
+
+def user_state(update: Update) -> UserState:
+    user_id = update.effective_user.id
+    state = _user_states.get(user_id)
+    if state is None:
+        state = _user_states[user_id] = UserState()
+    return state
+
+def clear_state(update: Update):
+    _user_states.pop(update.effective_user.id, None)
+
+def set_step(update: Update, step: str):
+    state = user_state(update)
+    state.step = step
+    state.step_ts = time.monotonic()
+
+def get_step(update: Update) -> Optional[str]:
+    """Current conversation step; an expired flow is cleared and reported as None."""
+    user = update.effective_user
+    state = _user_states.get(user.id) if user is not None else None
+    if state is None:
+        return None
+    if state.step is not None and time.monotonic() - state.step_ts > CONVERSATION_TTL:
+        clear_state(update)
+        return None
+    return state.step
+
+def parse_hhmm(text: str) -> dtime:
+    """Parse 'HH:MM' (24h) without strptime; raises ValueError on bad input."""
+    h, sep, m = text.partition(":")
+    if not (sep and text.isascii() and 1 <= len(h) <= 2 and 1 <= len(m) <= 2 and h.isdigit() and m.isdigit()):
+        raise ValueError(text)
+    return dtime(int(h), int(m))  # dtime() itself rejects hour > 23 / minute > 59
+
+# days from a weekday (Mon=0) to the nearest matching day, that day included
+_DAYS_TO_NEXT = {
+    "daily": (0, 0, 0, 0, 0, 0, 0),
+    "once": (0, 0, 0, 0, 0, 0, 0),
+    "weekdays": (0, 0, 0, 0, 0, 2, 1),
+    "weekends": (5, 4, 3, 2, 1, 0, 0),
+}
 
 def find_next_time(start: datetime, time_of_day, repeat: str) -> Optional[datetime]:
     """
@@ -100,147 +336,176 @@ def find_next_time(start: datetime, time_of_day, repeat: str) -> Optional[dateti
     repeat: 'daily'|'weekdays'|'weekends'|'once'
     Returns next datetime (aware KYIV_TZ) strictly > start that matches repeat.
     """
-    for i in range(0, 14):  # search up to 2 weeks to be safe
-        candidate_date = (start.date() + timedelta(days=i))
-        naive = datetime.combine(candidate_date, time_of_day.replace(tzinfo=None) if hasattr(time_of_day, "tzinfo") else time_of_day)
-        candidate = KYIV_TZ.localize(naive)
-        if candidate <= start:
-            continue
-        dow = candidate.weekday()  # 0..6 Mon..Sun
-        if repeat == "daily":
-            return candidate
-        if repeat == "weekdays" and dow < 5:
-            return candidate
-        if repeat == "weekends" and dow >= 5:
-            return candidate
-        if repeat == "once":
-            return candidate
-    return None
-
-def make_job_id(chat_id: int, dt: datetime, task: str) -> str:
-    # small unique-ish id
-    return f"{chat_id}_{int(dt.timestamp())}_{abs(hash(task))%100000}"
+    days_to_next = _DAYS_TO_NEXT.get(repeat)
+    if days_to_next is None:
+        return None
+    time_of_day = time_of_day.replace(tzinfo=None)  # may come from .timetz()
+    # today's slot already gone (wall-clock compare) -> start looking from tomorrow
+    offset = 1 if time_of_day <= start.time() else 0
+    offset += days_to_next[(start.weekday() + offset) % 7]
+    return datetime.combine(start.date() + timedelta(days=offset), time_of_day, tzinfo=KYIV_TZ)
+
+# seeded from the boot time so ids stay unique across restarts, not just within one process
+_job_counter = itertools.count(int(time.time() * 1000))
+
+def make_job_id(chat_id: int, dt: datetime) -> str:
+    return f"{chat_id}-{int(dt.timestamp())}-{next(_job_counter):x}"
 
 # ---------------- scheduling ----------------
-def schedule_reminder(job_queue, chat_id: int, remind_dt: datetime, task: str, repeat: str, reminder_obj: dict):
+# run_daily days for repeating reminders; PTB numbers them from Sunday (0=Sun .. 6=Sat)
+REPEAT_DAYS = {
+    "daily": (0, 1, 2, 3, 4, 5, 6),
+    "weekdays": (1, 2, 3, 4, 5),
+    "weekends": (0, 6),
+}
+
+def schedule_reminder(job_queue, chat_id: int, remind_dt: datetime, repeat: str, reminder_obj: dict,
+                      now: Optional[datetime] = None):
     """
     job_queue: app.job_queue or context.job_queue
-    reminder_obj: dict object from reminders[chat_id] list (will be mutated to set 'id')
+    reminder_obj: dict object from reminders[chat_id]; its 'id' is kept if already set
+    now: caller's current time, to avoid another datetime.now() call
     """
-    now = datetime.now(KYIV_TZ)
-    delay = (remind_dt - now).total_seconds()
-    if delay < 0:
-        delay = 0.1
-    job_id = make_job_id(chat_id, remind_dt, task)
-    # store id into object
-    reminder_obj["id"] = job_id
-    # schedule with job data containing our job_id
-    job_queue.run_once(job_send, delay, data={"chat_id": chat_id, "job_id": job_id})
+    job_id = reminder_obj.get("id")
+    if job_id is None:
+        job_id = make_job_id(chat_id, remind_dt)
+        # store id into object
+        reminder_obj["id"] = job_id
+    # schedule with job data containing our job_id; name it so the job can be found again
+    data = {"chat_id": chat_id, "job_id": job_id}
+    days = REPEAT_DAYS.get(repeat)
+    if days is not None:
+        # one job for the reminder's whole life; the scheduler skips days that don't match
+        job = job_queue.run_daily(job_send, remind_dt.timetz(), days=days, data=data, name=job_id)
+    else:
+        if now is None:
+            now = datetime.now(KYIV_TZ)
+        delay = (remind_dt - now).total_seconds()
+        if delay < 0:
+            delay = 0.1
+        job = job_queue.run_once(job_send, delay, data=data, name=job_id)
+    # keep the Job itself so deleting the reminder can cancel it (not persisted)
+    reminder_obj["job"] = job
     return job_id
 
+def cancel_reminder_job(rem: dict):
+    job = rem.pop("job", None)
+    if job is not None and not job.removed:
+        job.schedule_removal()
+
 # ---------------- handlers ----------------
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("Вітаю! Оберіть дію:", reply_markup=main_menu())
+    await update.message.reply_text("Вітаю! Оберіть дію:", reply_markup=MAIN_MENU_MARKUP)
 
-async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def main_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    chat_id = update.effective_chat.id
+    await safe_edit_message_text(query, "Головне меню:", reply_markup=MAIN_MENU_MARKUP)
 
-    if query.data == "main_menu":
-        await safe_edit_message_text(query, "Головне меню:", reply_markup=main_menu())
-        return
+async def set_reminder_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    set_step(update, "waiting_for_task")
+    await safe_edit_message_text(
+        query,
+        "Введіть текст нагадування:",
+        reply_markup=BACK_MARKUP
+    )
 
-    if query.data == "set_reminder":
-        context.user_data["step"] = "waiting_for_task"
-        await safe_edit_message_text(
-            query,
-            "Введіть текст нагадування:",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅ Назад", callback_data="main_menu")]])
-        )
-        return
+async def list_reminders_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    chat_id = query.message.chat.id
 
-    if query.data == "list_reminders":
-        user_reminders = reminders.get(chat_id, [])
-        if not user_reminders:
-            await safe_edit_message_text(query, "У вас немає активних нагадувань.", reply_markup=main_menu())
-            return
-        text = "📋 Ваші нагадування:\n"
-        keyboard = []
-        now = datetime.now(KYIV_TZ)
-        for i, r in enumerate(user_reminders):
-            remaining = format_time_delta(r["time"] - now)
-            text += f"{i+1}. {r['task']} ⏳ {remaining} ({r['repeat']})\n"
-            keyboard.append([InlineKeyboardButton(f"❌ Видалити {i+1}", callback_data=f"delete_{i}")])
-        keyboard.append([InlineKeyboardButton("⬅ Назад", callback_data="main_menu")])
-        await safe_edit_message_text(query, text, reply_markup=InlineKeyboardMarkup(keyboard))
+    user_reminders = reminders.get(chat_id, {})
+    if not user_reminders:
+        await safe_edit_message_text(query, "У вас немає активних нагадувань.", reply_markup=MAIN_MENU_MARKUP)
         return
+    # soonest first; buttons carry ids, so the order can change freely between renders
+    ordered = sorted(user_reminders.values(), key=itemgetter("time"))
+    now_ts = time.time()
+    lines = ["📋 Ваші нагадування:"]
+    lines.extend(
+        f"{i}. {r['task']} ⏳ {format_time_delta_seconds(r['time'].timestamp() - now_ts)} ({r['repeat']})"
+        for i, r in enumerate(ordered, 1)
+    )
+    keyboard = [
+        (InlineKeyboardButton(f"❌ Видалити {i}", callback_data=f"delete_{r['id']}"),)
+        for i, r in enumerate(ordered, 1)
+    ]
+    keyboard.append(BACK_ROW)
+    await safe_edit_message_text(query, "\n".join(lines), reply_markup=InlineKeyboardMarkup(keyboard))
 
-    if query.data.startswith("delete_"):
-        idx = int(query.data.split("_", 1)[1])
-        if chat_id in reminders and 0 <= idx < len(reminders[chat_id]):
-            rem = reminders[chat_id].pop(idx)
-            save_reminders()
-            await safe_edit_message_text(query, "Нагадування видалено.", reply_markup=main_menu())
-        else:
-            await safe_edit_message_text(query, "Нічого не знайдено.", reply_markup=main_menu())
-        return
+async def delete_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    chat_id = query.message.chat.id
+
+    job_id = context.matches[0].group(1)
+    user_reminders = reminders.get(chat_id)
+    rem = user_reminders.pop(job_id, None) if user_reminders else None
+    if rem is not None:
+        cancel_reminder_job(rem)
+        if not user_reminders:
+            reminders.pop(chat_id, None)
+        log_op("del", chat_id, rem)
+        await safe_edit_message_text(query, "Нагадування видалено.", reply_markup=MAIN_MENU_MARKUP)
+    else:
+        await safe_edit_message_text(query, "Нічого не знайдено.", reply_markup=MAIN_MENU_MARKUP)
 
 async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    chat_id = update.effective_chat.id
-    step = context.user_data.get("step")
+    step = get_step(update)
 
     if step == "waiting_for_task":
-        context.user_data["task"] = update.message.text
-        context.user_data["step"] = "waiting_for_time"
+        user_state(update).task = update.message.text
+        set_step(update, "waiting_for_time")
         await update.message.reply_text(
             "Введіть час у форматі HH:MM (24-годинний, київський час):",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅ Назад", callback_data="main_menu")]])
+            reply_markup=BACK_MARKUP
         )
         return
 
     if step == "waiting_for_time":
         text = update.message.text.strip()
         try:
-            chosen_time = datetime.strptime(text, "%H:%M").time()
+            chosen_time = parse_hhmm(text)
         except ValueError:
             await update.message.reply_text("Невірний формат. Використай HH:MM (наприклад 21:00).")
             return
         now = datetime.now(KYIV_TZ)
         # build candidate datetime for today at chosen_time
-        naive = datetime.combine(now.date(), chosen_time)
-        remind_dt = KYIV_TZ.localize(naive)
+        remind_dt = datetime.combine(now.date(), chosen_time, tzinfo=KYIV_TZ)
         # if already passed -> consider next day
         if remind_dt <= now:
             remind_dt += timedelta(days=1)
-        context.user_data["time"] = remind_dt
-        context.user_data["step"] = "waiting_for_repeat"
-
-        keyboard = [
-            [InlineKeyboardButton("Один раз", callback_data="repeat_once")],
-            [InlineKeyboardButton("Будні", callback_data="repeat_weekdays")],
-            [InlineKeyboardButton("Вихідні", callback_data="repeat_weekends")],
-            [InlineKeyboardButton("Щодня", callback_data="repeat_daily")],
-            [InlineKeyboardButton("⬅ Назад", callback_data="main_menu")]
-        ]
-        await update.message.reply_text("Оберіть тип повтору:", reply_markup=InlineKeyboardMarkup(keyboard))
+        user_state(update).remind_dt = remind_dt
+        set_step(update, "waiting_for_repeat")
+
+        await update.message.reply_text("Оберіть тип повтору:", reply_markup=REPEAT_MARKUP)
         return
 
-    # fallback
-    await update.message.reply_text("Використай меню.", reply_markup=main_menu())
+    # fallback; throttled so a burst of stray messages doesn't turn into a burst of replies
+    now = time.monotonic()
+    last = _menu_hints.get(update.effective_chat.id)
+    if last is not None and now - last < MENU_HINT_COOLDOWN:
+        return
+    _menu_hints[update.effective_chat.id] = now
+    await update.message.reply_text("Використай меню.", reply_markup=MAIN_MENU_MARKUP)
 
 async def repeat_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    chat_id = update.effective_chat.id
+    chat_id = query.message.chat.id
 
-    task = context.user_data.get("task")
-    chosen_dt: datetime = context.user_data.get("time")
-    repeat_type = query.data.replace("repeat_", "")
+    get_step(update)  # drops the flow if it has expired
+    state = user_state(update)
+    task = state.task
+    chosen_dt = state.remind_dt
+    repeat_type = context.matches[0].group(1)
 
     if not task or not chosen_dt:
-        await safe_edit_message_text(query, "Щось пішло не так. Почни заново.", reply_markup=main_menu())
-        context.user_data.clear()
+        await safe_edit_message_text(query, "Щось пішло не так. Почни заново.", reply_markup=MAIN_MENU_MARKUP)
+        clear_state(update)
         return
 
     now = datetime.now(KYIV_TZ)
@@ -251,22 +516,69 @@ async def repeat_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # find next matching datetime (could be today or later)
         scheduled_dt = find_next_time(now, chosen_dt.timetz(), repeat_type)
         if scheduled_dt is None:
-            await safe_edit_message_text(query, "Не вдалося знайти підходящу дату.", reply_markup=main_menu())
-            context.user_data.clear()
+            await safe_edit_message_text(query, "Не вдалося знайти підходящу дату.", reply_markup=MAIN_MENU_MARKUP)
+            clear_state(update)
             return
 
     # create reminder object and persist
     rem = {"id": None, "task": task, "time": scheduled_dt, "repeat": repeat_type}
-    reminders.setdefault(chat_id, []).append(rem)
     # schedule and set id
-    job_id = schedule_reminder(context.job_queue, chat_id, scheduled_dt, task, repeat_type, rem)
-    # persist id into file
-    save_reminders()
+    job_id = schedule_reminder(context.job_queue, chat_id, scheduled_dt, repeat_type, rem, now=now)
+    reminders.setdefault(chat_id, {})[job_id] = rem
+    log_op("add", chat_id, rem)
 
-    await safe_edit_message_text(query, "Нагадування створено ✅", reply_markup=main_menu())
-    context.user_data.clear()
+    await safe_edit_message_text(query, "Нагадування створено ✅", reply_markup=MAIN_MENU_MARKUP)
+    clear_state(update)
 
 # ---------------- job callback ----------------
+# reminders firing for one chat within this many seconds are sent together
+BATCH_WINDOW = 0.75
+MAX_MESSAGE_LEN = 4096
+REMINDER_HEADER = "🔔 Нагадування:"
+
+# chat_id -> fired reminders waiting for flush_reminders
+_outbox: dict = {}
+
+def reminder_messages(tasks: list) -> list:
+    """Message texts for reminders due together, each within Telegram's length limit."""
+    if len(tasks) == 1:
+        return [f"{REMINDER_HEADER} {tasks[0]}"]
+    messages = []
+    parts = [REMINDER_HEADER]
+    size = len(REMINDER_HEADER)
+    for task in tasks:
+        line = f"• {task}"
+        if len(parts) > 1 and size + 1 + len(line) > MAX_MESSAGE_LEN:
+            messages.append("\n".join(parts))
+            parts = [REMINDER_HEADER]
+            size = len(REMINDER_HEADER)
+        parts.append(line)
+        size += 1 + len(line)
+    messages.append("\n".join(parts))
+    return messages
+
+async def send_batch(bot, chat_id: int, rems: list):
+    for text in reminder_messages([r["task"] for r in rems]):
+        try:
+            await bot.send_message(chat_id, text=text)
+        except Exception:
+            # a failed send doesn't stop the rest of the batch
+            pass
+    # one-off reminders are deleted from the store only once they've been sent
+    for rem in rems:
+        if rem["repeat"] == "once":
+            log_op("del", chat_id, rem)
+
+async def flush_reminders(context: ContextTypes.DEFAULT_TYPE):
+    chat_id = context.job.chat_id
+    await send_batch(context.bot, chat_id, _outbox.pop(chat_id, []))
+
+async def drain_outbox(app):
+    """Send batches whose flush job was dropped by the stopping JobQueue."""
+    while _outbox:
+        chat_id, rems = _outbox.popitem()
+        await send_batch(app.bot, chat_id, rems)
+
 async def job_send(context: ContextTypes.DEFAULT_TYPE):
     job_data = context.job.data or {}
     chat_id = job_data.get("chat_id")
@@ -276,75 +588,147 @@ async def job_send(context: ContextTypes.DEFAULT_TYPE):
         return
 
     # find reminder
-    user_list = reminders.get(chat_id, [])
-    rem = next((r for r in user_list if r.get("id") == job_id), None)
-    if rem is None:
-        # maybe removed; nothing to do
+    user_reminders = reminders.get(chat_id, {})
+    rem = user_reminders.get(job_id)
+    if rem is None or rem.get("job") is not context.job:
+        # removed or superseded by a newer job; nothing to do
         return
 
-    # send notification
-    try:
-        await context.bot.send_message(chat_id, text=f"🔔 Нагадування: {rem['task']}")
-    except Exception:
-        # if sending fails, keep reminder as is
-        pass
+    # queue the notification; reminders due at the same moment go out as one message
+    pending = _outbox.get(chat_id)
+    if pending is None:
+        pending = _outbox[chat_id] = []
+        context.job_queue.run_once(flush_reminders, BATCH_WINDOW, chat_id=chat_id)
+    pending.append(rem)
 
     # handle repeat logic
     if rem["repeat"] == "once":
-        # remove it
-        reminders[chat_id] = [r for r in user_list if r.get("id") != job_id]
-        if not reminders[chat_id]:
+        # drop it from the index now; send_batch logs the delete after sending
+        user_reminders.pop(job_id, None)
+        if not user_reminders:
             reminders.pop(chat_id, None)
-        save_reminders()
         return
 
-    # for repeating reminders: compute next occurrence strictly after now
-    now = datetime.now(KYIV_TZ)
-    next_dt = find_next_time(now, rem["time"].timetz(), rem["repeat"])
-    if next_dt is None:
-        # nothing to schedule
-        return
+    # repeating reminders keep their run_daily job; only move the shown time forward.
+    # not logged: load_reminders() rolls a past repeat time forward on start anyway
+    next_dt = find_next_time(datetime.now(KYIV_TZ), rem["time"].timetz(), rem["repeat"])
+    if next_dt is not None:
+        rem["time"] = next_dt
 
-    # update stored rem and save, then schedule next job
-    rem["time"] = next_dt
-    # clear old id; schedule_reminder will set new id
-    rem["id"] = None
-    save_reminders()
-    schedule_reminder(context.job_queue, chat_id, next_dt, rem["task"], rem["repeat"], rem)
-    save_reminders()
+async def sweep_jobs(context: ContextTypes.DEFAULT_TYPE):
+    """Drop reminder jobs that no longer belong to a stored reminder."""
+    for job in context.job_queue.jobs():
+        if job.callback is not job_send:
+            continue
+        job_data = job.data or {}
+        rem = reminders.get(job_data.get("chat_id"), {}).get(job_data.get("job_id"))
+        if rem is None or rem.get("job") is not job:
+            job.schedule_removal()
+
+async def prune_state(context: ContextTypes.DEFAULT_TYPE):
+    """Forget abandoned add-reminder flows and expired menu-hint cooldowns."""
+    now = time.monotonic()
+    for user_id, state in list(_user_states.items()):
+        if state.step is None or now - state.step_ts > CONVERSATION_TTL:
+            del _user_states[user_id]
+    for chat_id, last in list(_menu_hints.items()):
+        if now - last > MENU_HINT_COOLDOWN:
+            del _menu_hints[chat_id]
 
 # ---------------- restore on start ----------------
 def restore_jobs(app):
     now = datetime.now(KYIV_TZ)
-    for chat_id, rem_list in list(reminders.items()):
-        for rem in rem_list:
+    for chat_id, user_reminders in list(reminders.items()):
+        for job_id, rem in list(user_reminders.items()):
             # ensure rem['time'] is > now; if not, compute next for repeats or remove for once
             if rem["time"] <= now:
                 if rem["repeat"] == "once":
                     # remove expired once
-                    reminders[chat_id] = [r for r in rem_list if r is not rem]
+                    user_reminders.pop(job_id)
                     continue
                 next_dt = find_next_time(now, rem["time"].timetz(), rem["repeat"])
                 if next_dt is None:
-                    reminders[chat_id] = [r for r in rem_list if r is not rem]
+                    user_reminders.pop(job_id)
                     continue
                 rem["time"] = next_dt
             # schedule
-            schedule_reminder(app.job_queue, chat_id, rem["time"], rem["task"], rem["repeat"], rem)
-    save_reminders()
+            schedule_reminder(app.job_queue, chat_id, rem["time"], rem["repeat"], rem, now=now)
+        if not user_reminders:
+            reminders.pop(chat_id, None)
+    # store the rolled-forward times and drop reminders that expired while down
+    store_all_reminders(all_reminder_rows())
+
+# ---------------- update processing ----------------
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates concurrently across chats, but one at a time within a chat."""
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        # chat_id -> updates waiting behind the one being processed for that chat
+        self._queues: dict = {}
+
+    async def do_process_update(self, update, coroutine):
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            await coroutine
+            return
+        queue = self._queues.get(chat.id)
+        if queue is not None:
+            # chat busy: its running update picks this one up next, so a backlog in
+            # one chat holds a single concurrency slot instead of one per update
+            queue.append(coroutine)
+            return
+        queue = self._queues[chat.id] = deque()
+        try:
+            while True:
+                await coroutine
+                if not queue:
+                    break
+                coroutine = queue.popleft()
+        finally:
+            # idle chat -> drop its queue so the table only holds active chats
+            del self._queues[chat.id]
+            for pending in queue:
+                pending.close()  # cancelled mid-backlog (shutdown)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
 
 # ---------------- run ----------------
 def run_app():
     load_reminders()
 
-    app = ApplicationBuilder().token(TOKEN).build()
+    app = (
+        ApplicationBuilder()
+        .token(TOKEN)
+        # a larger warm pool so reminders firing in the same minute don't queue for connections
+        .connection_pool_size(64)
+        .http_version("2")
+        # a slow call for one chat doesn't hold up the others; a chat's own updates stay in order
+        .concurrent_updates(PerChatUpdateProcessor(256))
+        # pace outgoing calls under Telegram's ~30 msg/s limit and retry on 429
+        .rate_limiter(AIORateLimiter(overall_max_rate=28, max_retries=3))
+        .post_init(start_save_worker)
+        # runs after the JobQueue stops and before the writer's final flush
+        .post_stop(drain_outbox)
+        .post_shutdown(stop_save_worker)
+        .build()
+    )
 
     app.add_handler(CommandHandler("start", start))
-    app.add_handler(CallbackQueryHandler(button_handler, pattern=r"^(set_reminder|list_reminders|main_menu|delete_\d+)$"))
-    app.add_handler(CallbackQueryHandler(repeat_handler, pattern=r"^repeat_"))
+    app.add_handler(CallbackQueryHandler(main_menu_handler, pattern=r"^main_menu$"))
+    app.add_handler(CallbackQueryHandler(set_reminder_handler, pattern=r"^set_reminder$"))
+    app.add_handler(CallbackQueryHandler(list_reminders_handler, pattern=r"^list_reminders$"))
+    app.add_handler(CallbackQueryHandler(delete_handler, pattern=DELETE_RE))
+    app.add_handler(CallbackQueryHandler(repeat_handler, pattern=REPEAT_RE))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler))
 
     restore_jobs(app)
+    app.job_queue.run_repeating(sweep_jobs, interval=3600, first=3600)
+    app.job_queue.run_repeating(prune_state, interval=1800, first=1800)
 
     # build webhook_url: RENDER_EXTERNAL_URL should be like 'your-service.onrender.com'
     webhook_url = WEBHOOK_URL if WEBHOOK_URL and WEBHOOK_URL.startswith("http") else (f"https://{WEBHOOK_URL}" if WEBHOOK_URL else None)